@@ -13,19 +13,26 @@ Requirements:
     pip3 install xmltodict
     pip3 install atlassian-python-api
     pip3 install bs4
+    pip3 install lxml
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import browser_cookie3
 import xmltodict
+from lxml import etree
 from atlassian import Confluence
-from bs4 import BeautifulSoup, NavigableString
+from bs4 import BeautifulSoup, CData, NavigableString
 
+import copy
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import pprint
-import math
 import os
+import shutil
+import threading
 from urllib.parse import urlparse
 import unicodedata
 import logging
@@ -130,80 +137,120 @@ else:
     raise SystemExit
 
 
+def entry_list(feed):
+    # same one-vs-many quirk for feed entries - always hand back a list
+    entries = feed.get('entry', [])
+    if isinstance(entries, dict):
+        entries = [entries]
+    return entries
+
+
 class XmlWorker:
     def __init__(self, xmldata):
         self.xmldata = xmldata
 
     def getDict(self):
-        dict_of_feed = json.dumps(xmltodict.parse(self.xmldata))
-        return json.loads(dict_of_feed)
-
-    def getWikiSecondId(self, xmldict):
-        second_id = xmldict['feed']['id']
-        just_the_id = second_id.replace("urn:lsid:ibm.com:td:", "")
-        return just_the_id
+        # xmltodict already turns on expat text buffering internally and
+        # returns a plain dict, no need to bounce it through json
+        # disable_entities spelled out so older xmltodict versions don't expand
+        # entity bombs either
+        return xmltodict.parse(self.xmldata, disable_entities=True)
+
+    def parseIndexFeed(self):
+        # stream an index feed batch with lxml the same way the attachment
+        # feeds are walked - each entry is boiled down to the few fields the
+        # page list needs and then cleared, so the full dict tree (entry
+        # summaries included) never gets built
+        ns_atom = '{http://www.w3.org/2005/Atom}'
+        ns_td = '{urn:ibm.com/td}'
+        ns_os = '{http://a9.com/-/spec/opensearch/1.1/}'
+        entries = []
+        index_parse = etree.iterparse(self.xmldata, events=('end',), tag=ns_atom + 'entry')
+        for event, entry in index_parse:
+            link_hrefs = []
+            link_rels = {}
+            for link in entry.findall(ns_atom + 'link'):
+                link_hrefs.append(link.get('href'))
+                link_rels[link.get('rel')] = link.get('href')
+            author = entry.find(ns_atom + 'author')
+            modifier = entry.find(ns_td + 'modifier')
+            entries.append({'title': entry.findtext(ns_atom + 'title')
+                , 'link': link_hrefs[1] if len(link_hrefs) > 1 else None  # second href has the best url
+                , 'author': author.findtext(ns_atom + 'name') if author is not None else None
+                , 'created': entry.findtext(ns_td + 'created')
+                , 'modifier': modifier.findtext(ns_atom + 'name') if modifier is not None else None
+                , 'modified': entry.findtext(ns_td + 'modified')
+                , 'page_id': entry.findtext(ns_td + 'uuid')
+                , 'download_url': link_rels.get('enclosure')
+                , 'media_url': link_rels.get('edit-media')})
+            # shed the entry's children but leave the feed-level fields alone
+            entry.clear()
+        feed_root = index_parse.root
+        next_url = None
+        for link in feed_root.findall(ns_atom + 'link'):
+            if link.get('rel') == 'next':
+                next_url = link.get('href')
+        return {'entries': entries
+            , 'next_url': next_url
+            , 'wiki_id': (feed_root.findtext(ns_atom + 'id') or '').replace('urn:lsid:ibm.com:td:', '')
+            , 'title': feed_root.findtext(ns_atom + 'title')
+            , 'total_results': feed_root.findtext(ns_os + 'totalResults')}
+
+    def iterAttachmentEntries(self):
+        # walk the attachment feed with lxml at C speed instead of building the
+        # whole dict tree, only pulling the few fields the attachment loop reads
+        # clearing each entry as we go keeps memory flat on attachment-heavy pages
+        ns_atom = '{http://www.w3.org/2005/Atom}'
+        for event, entry in etree.iterparse(self.xmldata, events=('end',), tag=ns_atom + 'entry'):
+            x_attach_size = None
+            for link in entry.findall(ns_atom + 'link'):
+                if link.get('rel') == 'enclosure':
+                    x_attach_size = link.get('length')
+            content = entry.find(ns_atom + 'content')
+            title = entry.find(ns_atom + 'title')
+            yield {'content': content.get('src') if content is not None else None
+                   , 'type': content.get('type') if content is not None else None
+                   , 'title': title.text if title is not None else None
+                   , 'size_bytes': x_attach_size}
+            entry.clear()
+            while entry.getprevious() is not None:
+                del entry.getparent()[0]
 
 
 class WikiWorker:
-    def __init__(self, wikiid, cookies, headers):
+    def __init__(self, wikiid, session):
         self.wikiid = wikiid
-        self.cookies = cookies
-        self.headers = headers
+        self.session = session
         self.wiki_feed_pages = []
         self.nav_id = ""
 
-    def getIndexUrl(self, w3_number_of_pages):
-        w3_index = '{}/wikis/form/api/wiki/{}/feed?ps={}&includeTags=true&sK=modified&sO=dsc' \
-            .format(w3_host, self.wikiid, w3_number_of_pages)
-        self.w3_wiki_index_url = w3_index
-        return w3_index
-
-    def getAttachmentUrl(self, secondid, pageid):
-        w3_attachment = '{}/wikis/basic/api/wiki/{}/page/{}/feed?category=attachment' \
-            .format(w3_host, secondid, pageid)
-        return w3_attachment
-
     def convertSize(self, size_bytes):
         size_bytes = int(size_bytes)
         if size_bytes == 0:
             return "0 B"
         size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-        i = int(math.floor(math.log(size_bytes, 1024)))
-        p = math.pow(1024, i)
-        s = round(size_bytes / p, 2)
-        return "%s %s" % (s, size_name[i])
+        # bit_length picks the base-1024 exponent in one integer op
+        i = min((size_bytes.bit_length() - 1) // 10, len(size_name) - 1)
+        return "%s %s" % (round(size_bytes / (1 << (10 * i)), 2), size_name[i])
 
     def getWikiIndexFeed(self, index_url):
-        r = requests.get(index_url, cookies=self.cookies, headers=self.headers)
-        return r.text
-
-    def get_next_feed_page(self, feed_json):
-        next_feed_page = None
-        feed_link_type = type(feed_json['feed']['link'])
-        if feed_link_type is list:
-            for link in feed_json['feed']['link']:
-                if link['@rel'] == 'next':
-                    next_feed_page = link['@href']
-        return next_feed_page
+        # stream the feed and hand the raw file-like straight to the XML parser
+        # so we never hold the whole response as one big string
+        r = self.session.get(index_url, stream=True)
+        r.raw.decode_content = True
+        return r.raw
 
     def add_wiki_feed_pages(self, page_items):
-        items_type = type(page_items)
-        # if it's a list, there's more than one entry
-        # if it's a dict, there's just one entry so we need to change the way we append
-        if items_type is list:
-            num_of_items = len(page_items)
-            for its in page_items:
-                self.wiki_feed_pages.append(its)
-        else:
-            num_of_items = 1
-            self.wiki_feed_pages.append(page_items)
+        # the stream parser always hands back a list, even for one entry
+        self.wiki_feed_pages.extend(page_items)
         if len(self.wiki_feed_pages) != int(w3_number_of_pages):
-            logger.info("Found {} more pages".format(num_of_items))
+            logger.info("Found {} more pages".format(len(page_items)))
 
     def get_wiki_page_comments(self, second_id, page_id):
         feed_page_url = "{}/wikis/form/api/wiki/{}/page/{}/feed".format(w3_host, second_id, page_id)
-        r = requests.get(feed_page_url, cookies=self.cookies, headers=self.headers)
-        return r.text
+        r = self.session.get(feed_page_url, stream=True)
+        r.raw.decode_content = True
+        return r.raw
 
 
 # in case we find things that didn't break the script but should be noticed
@@ -212,19 +259,18 @@ alert_items = []
 # Capture entire process start time
 startSyncTime = datetime.now()
 
-# get cookies for all domains that include ibm or collabserv
-if 'collabserv' in urlparse(w3_wiki_url).netloc:
-    d_name = 'apps.na.collabserv.com'
-else:
-    d_name = 'ibm.com'
+# W3 connections needs cookies from these domains
+w3_cookie_domains = frozenset({'.ibm.com', 'w3-connections.ibm.com', 'apps.na.collabserv.com'})
 
-ibm_cookies = browser_cookie3.chrome(domain_name=d_name)
+# decrypt the Chrome cookie DB once and filter in Python - every
+# browser_cookie3.chrome() call unlocks the keychain all over again,
+# and the Confluence login below reuses this same jar
+browser_cookies = browser_cookie3.chrome()
 
 cookies = {}
 
-for co in ibm_cookies:
-    # W3 connections needs cookies from these domains
-    if co.domain in ['.ibm.com', 'w3-connections.ibm.com', 'apps.na.collabserv.com']:
+for co in browser_cookies:
+    if co.domain in w3_cookie_domains:
         cookies[co.name] = co.value
 
 logger.debug(cookies)
@@ -233,12 +279,29 @@ logger.debug(cookies)
 headers = {
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) '
                   'Chrome/35.0.1916.47 Safari/537.36'}
+
+# one session for all the W3 calls so we keep the connection alive
+# instead of doing a new TCP/TLS handshake for every single request
+w3_session = requests.Session()
+w3_session.cookies.update(cookies)
+w3_session.headers.update(headers)
+w3_session.mount('https://', HTTPAdapter(
+    pool_connections=4, pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])))
+
+# thread pool shared by the IO-bound fetch loops
+# threads are fine here because requests releases the GIL while waiting on the socket
+# pool_maxsize above matches so every worker can hold a connection
+fetch_pool = ThreadPoolExecutor(max_workers=16)
+# lock + counter so the parallel loops can still report progress
+progress_lock = threading.Lock()
+
 # make request to the W3 index with the cookies and header created earlier
 logger.info("Making request for W3 Wiki Index")
 
 # build out wiki details
-wiki_meta = WikiWorker(w3_wiki_id, cookies, headers)
-w3_index_url = wiki_meta.getIndexUrl(w3_number_of_pages)
+wiki_meta = WikiWorker(w3_wiki_id, w3_session)
+w3_index_url = f'{w3_host}/wikis/form/api/wiki/{w3_wiki_id}/feed?ps={w3_number_of_pages}&includeTags=true&sK=modified&sO=dsc'
 
 try:
     wiki_feed = wiki_meta.getWikiIndexFeed(w3_index_url)
@@ -246,37 +309,36 @@ except Exception as e:
     logger.error("Unable to get the wiki, make sure you're on AnyConnect\nError: {}".format(e), exc_info=True)
     raise SystemExit
 
-logger.debug(wiki_feed)
-
 # start parsing the W3 index and get additional ids needed
-xml_wiki_index = XmlWorker(wiki_feed)
 logger.info("Trying to parse XML for Wiki Index")
-items = None
 try:
-    items = xml_wiki_index.getDict()
+    index_feed = XmlWorker(wiki_feed).parseIndexFeed()
 except Exception as e:
     logger.error("Unable to parse XML, make sure you're logged in to W3 in Chrome\nError: {}".format(e), exc_info=True)
     raise SystemExit
 
 # get the wiki label used in other API calls
-logger.debug(json.dumps(items))
-wiki_second_id = xml_wiki_index.getWikiSecondId(items)
+wiki_second_id = index_feed['wiki_id']
 logger.info("Found secondary/label W3 ID: " + wiki_second_id)
 
 # add the initial load of entries
-wiki_meta.add_wiki_feed_pages(items['feed']['entry'])
+wiki_meta.add_wiki_feed_pages(index_feed['entries'])
 
 if sync_to_confluence:
     # make sure you're logged into Confluence
-    conf_cookies = requests.utils.dict_from_cookiejar(
-        browser_cookie3.chrome(
-            domain_name=urlparse(conf_endpoint).hostname)
-    )
-    # conf_cookies = chrome_cookies(conf_endpoint)
+    # filter the already-decrypted jar the same way browser_cookie3 would
+    conf_hostname = urlparse(conf_endpoint).hostname
+    conf_cookies = {co.name: co.value for co in browser_cookies if conf_hostname in co.domain}
     logger.info("Trying to login to Confluence and get space details")
+    # give Confluence its own keep-alive session too so page/attachment uploads reuse sockets
+    conf_session = requests.Session()
+    conf_session.cookies.update(conf_cookies)
+    # sized to the fetch pool so parallel uploads each keep a warm connection
+    # instead of handshaking TLS per call
+    conf_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
     confluence = Confluence(
         url=conf_endpoint,
-        cookies=conf_cookies)
+        session=conf_session)
 
     space_details = confluence.get_space(conf_space_name)
     logger.debug(space_details)
@@ -296,8 +358,8 @@ if sync_to_confluence:
 
 # determine how many pages are from the index
 try:
-    number_of_expected_pages = items['feed']['opensearch:totalResults']
-    wiki_title = items['feed']['title']['#text']
+    number_of_expected_pages = index_feed['total_results']
+    wiki_title = index_feed['title']
     logger.info(
         "Expecting {} total pages in Wiki named '{}', getting {} pages at a time".format(number_of_expected_pages,
                                                                                          wiki_title,
@@ -308,16 +370,14 @@ except Exception as e:
 
 # Look for more wiki index feeds to download
 # by seeing if there's another feed page listed
-first_next_url = wiki_meta.get_next_feed_page(items)
+first_next_url = index_feed['next_url']
 if first_next_url is not None and stop_after_first_index_scan is False:
     logger.info("Next page URL: {}".format(first_next_url))
     url_index_to_get = first_next_url
     while True:
-        new_feed = wiki_meta.getWikiIndexFeed(url_index_to_get)
-        xml_next_wiki_index = XmlWorker(new_feed)
-        next_items = xml_next_wiki_index.getDict()
-        wiki_meta.add_wiki_feed_pages(next_items['feed']['entry'])
-        next_page_url = wiki_meta.get_next_feed_page(next_items)
+        next_index_feed = XmlWorker(wiki_meta.getWikiIndexFeed(url_index_to_get)).parseIndexFeed()
+        wiki_meta.add_wiki_feed_pages(next_index_feed['entries'])
+        next_page_url = next_index_feed['next_url']
         if next_page_url is not None:
             logger.info("Next page URL: {}".format(next_page_url))
             # now let's do this again with the next page url
@@ -333,21 +393,43 @@ else:
 pages_to_download = []
 
 
+# cache of page id -> parent id so sibling pages sharing ancestors
+# don't each trigger their own navigation request
+parent_id_cache = {}
+
+
 class NavigationWorker:
     def __init__(self, pageid, navid):
         self.pageid = pageid
         self.navid = navid
 
-    def get_parent_id(self, the_cookies, the_headers):
-        na = requests.get(
+    def get_parent_id(self, the_session):
+        if self.pageid in parent_id_cache:
+            return parent_id_cache[self.pageid]
+        na = the_session.get(
             '{}/wikis/basic/api/wiki/{}/navigation/{}/entry?format=json&includeBreadcrumbs=true'.format(w3_host,
                                                                                                         self.navid,
-                                                                                                        self.pageid),
-            cookies=the_cookies, headers=the_headers)
-        pageParentId = json.loads(na.text)['parent']
+                                                                                                        self.pageid))
+        nav_entry = json.loads(na.text)
+        pageParentId = nav_entry['parent']
+        parent_id_cache[self.pageid] = pageParentId
+        # we already asked for breadcrumbs, so mine the whole ancestor chain
+        # instead of throwing it away - every pair seeds the cache for later pages
+        breadcrumbs = nav_entry.get('breadcrumbs') or []
+        for crumb_parent, crumb_child in zip(breadcrumbs, breadcrumbs[1:]):
+            crumb_child_id = crumb_child.get('id')
+            if crumb_child_id is not None and crumb_child_id not in parent_id_cache:
+                parent_id_cache[crumb_child_id] = crumb_parent.get('id')
         return pageParentId
 
 
+def w3_date_display(ts):
+    # the feed timestamps are a fixed ISO layout like 2020-01-31T12:34:56.789Z,
+    # so slice out month/day/year directly rather than paying for a strptime
+    # plus strftime round-trip on every page
+    return "{}/{}/{}".format(ts[5:7], ts[8:10], ts[0:4])
+
+
 # build out the dictionary with the info of the page
 def create_page_append(url, title, link, author, created, modifier, modified, media_link, page_id, attachments,
                        parent_id):
@@ -355,55 +437,41 @@ def create_page_append(url, title, link, author, created, modifier, modified, me
         , 'title': title
         , 'link': link
         , 'author': author
-        , 'created': created.strftime("%m/%d/%Y")
+        , 'created': created
         , 'modifier': modifier
-        , 'modified': modified.strftime("%m/%d/%Y")
+        , 'modified': modified
         , 'media_url': media_link
         , 'page_id': page_id
         , 'attachments': attachments
         , 'parent_id': parent_id}
 
 
-logger.info("Please wait, indexing Wiki and getting parent page ids for navigation")
-
-for i, it in enumerate(wiki_meta.wiki_feed_pages):
-    if i % 20 == 0 and i != 0:
-        logger.info("Found {} parent ids so far".format(i))
-    x_title = it['title']['#text']
-    x_link = it['link'][1]['@href']  # second href has the best url
-    x_author = it['author']['name']
-    x_created = datetime.strptime(it['td:created'], "%Y-%m-%dT%H:%M:%S.%fZ")
-    x_modifier = it['td:modifier']['name']
-    x_modified = datetime.strptime(it['td:modified'], "%Y-%m-%dT%H:%M:%S.%fZ")
-    x_page_id = it['td:uuid']
-    x_download_link = None
-    x_media_link = None
-    x_attachment_link = wiki_meta.getAttachmentUrl(wiki_second_id, x_page_id)
-    nav = NavigationWorker(x_page_id, wiki_second_id)
-    x_parent_id = nav.get_parent_id(cookies, headers)
-
-    # find the enclosure URL so we can download the HTML
-    for l in it['link']:
-        if l['@rel'] == 'enclosure':
-            x_download_link = l['@href']
-
-    for l in it['link']:
-        if l['@rel'] == 'edit-media':
-            x_media_link = l['@href']
+logger.info("Please wait, indexing Wiki")
+
+
+def index_feed_entry(it):
+    # the stream parser already pulled the raw fields; just format the dates
+    # and derive the attachment feed url
+    x_page_id = it['page_id']
+    # inline f-string - this runs once per index entry and needs no method hop
+    x_attachment_link = f'{w3_host}/wikis/basic/api/wiki/{wiki_second_id}/page/{x_page_id}/feed?category=attachment'
 
     # generate a dictionary of page items
-    pages_to_download.append(
-        create_page_append(
-            x_download_link, x_title, x_link
-            , x_author, x_created, x_modifier
-            , x_modified, x_media_link, x_page_id
-            , x_attachment_link, x_parent_id
-        )
+    # parent id is filled in later by the combined metadata pass
+    return create_page_append(
+        it['download_url'], it['title'], it['link']
+        , it['author'], w3_date_display(it['created']), it['modifier']
+        , w3_date_display(it['modified']), it['media_url'], x_page_id
+        , x_attachment_link, None
     )
 
+
+# no network involved anymore, this is just reshaping the feed entries
+pages_to_download = [index_feed_entry(it) for it in wiki_meta.wiki_feed_pages]
+
 # store the number of pages to download so we can present it later without calculating
 number_of_pages_to_download = len(pages_to_download)
-logger.info("Finished indexing {} Wiki pages and getting their parent pages".format(number_of_pages_to_download))
+logger.info("Finished indexing {} Wiki pages".format(number_of_pages_to_download))
 
 
 def create_conf_page(title, body, parent_id=None):
@@ -443,7 +511,9 @@ def create_conf_page(title, body, parent_id=None):
         raise SystemExit
 
 
-conf_attachment_mapping = []
+# (page id, file name) -> attachment id, so the per-image/per-link lookups
+# are a single dict access instead of a scan over everything uploaded so far
+conf_attachment_mapping = {}
 
 
 def create_conf_attachment(page_id, file_name, file):
@@ -455,7 +525,7 @@ def create_conf_attachment(page_id, file_name, file):
         if 'id' in status['results'][0]:
             new_attachment_id = status['results'][0]['id']
             logger.info("Created attachment id " + new_attachment_id)
-            conf_attachment_mapping.append({'file_name': file_name, 'page_id': page_id, 'attach_id': new_attachment_id})
+            conf_attachment_mapping[(str(page_id), file_name)] = new_attachment_id
         else:
             logger.info("ERROR: Couldn't attach file...")
             logger.debug(status)
@@ -464,7 +534,8 @@ def create_conf_attachment(page_id, file_name, file):
         raise SystemExit
 
 
-existing_conf_pages = []
+# a set because every W3 page title gets checked against it
+existing_conf_pages = set()
 
 homepage_id = None
 if sync_to_confluence:
@@ -472,19 +543,23 @@ if sync_to_confluence:
 
 
     def get_conf_page_titles(start=0):
-        conf_all_pages = confluence.get_all_pages_from_space(conf_space_name, start=start, limit=100, expand='space')
+        # we only ever read the titles, so don't ask Confluence to expand anything
+        conf_all_pages = confluence.get_all_pages_from_space(conf_space_name, start=start, limit=100)
         for c in conf_all_pages:
-            existing_conf_pages.append(c['title'])
+            existing_conf_pages.add(c['title'])
         return len(conf_all_pages)
 
 
+    # the API doesn't hand us a total up front, so fetch offsets in parallel
+    # waves and stop as soon as a wave includes a short or empty batch
     conf_page_count = 0
+    conf_title_wave = 4
     while True:
-        num_pages_returned = get_conf_page_titles(conf_page_count)
-        if num_pages_returned > 0:
-            conf_page_count += 100
-            logger.info("Getting more confluence page titles, catalogued {} so far".format(len(existing_conf_pages)))
-        else:
+        wave_starts = range(conf_page_count, conf_page_count + conf_title_wave * 100, 100)
+        batch_sizes = list(fetch_pool.map(get_conf_page_titles, wave_starts))
+        conf_page_count += conf_title_wave * 100
+        logger.info("Getting more confluence page titles, catalogued {} so far".format(len(existing_conf_pages)))
+        if min(batch_sizes) < 100:
             break
 
     logger.debug(pprint.pformat(existing_conf_pages))
@@ -525,112 +600,97 @@ if sync_to_confluence:
         raise SystemExit
 
 logger.info("#" * 20)
-logger.info("Looking for attachments on pages")
+logger.info("Collecting parent ids, attachments and comments for pages")
 logger.info("#" * 20)
 
-# dictionary to hold attachment metadata using page id as key
+# dictionaries holding attachment/comment metadata using page id as key
 attachments_to_download = {}
+wiki_comment_data = {}
 
-# start searching for attachments on the pages collected
-for i, x in enumerate(pages_to_download):
-    if i % 20 == 0 and i != 0:
-        logger.info("Searched {} pages for attachments so far, {} pages with attachments".format(i, len(
-            attachments_to_download)))
-    # download attachment metadata
-    attach_data = requests.get(x['attachments'], cookies=cookies, headers=headers)
-    attach_xml = XmlWorker(attach_data.text)
-    # make the metadata into a dictionary
-    attach_meta = attach_xml.getDict()
-    # setup empty list to hold dictionaries of the attachment metadata
-    attachment_info = []
-    num_of_attachments = attach_meta['feed']['opensearch:totalResults']
-    logger.debug("{} -- Num of attachments: {}".format(x['title'], num_of_attachments))
-
-    # Ughh, the W3 XML changes if there is exactly one attachment
-    # Duplicating some code here, come back and cleanup later :(
-    if num_of_attachments == '1':
-        at = attach_meta['feed']['entry']
-        x_attach_size = None
-        for attach in at['link']:
-            if attach['@rel'] == 'enclosure':
-                x_attach_size = attach['@length']
-
-        attachment_info.append({'content': at['content']['@src']
-                                   , 'type': at['content']['@type']
-                                   , 'title': at['title']['#text']
-                                   , 'size_bytes': x_attach_size
-                                   , 'size_human': wiki_meta.convertSize(x_attach_size)})
+# only bother fetching comments if they'll end up on the Confluence pages
+collect_comments = sync_to_confluence and append_wiki_comments
 
-        attachments_to_download[x['page_id']] = attachment_info
-
-    # assumes there is more than one attachment
-    elif num_of_attachments not in ['0', '1']:
-        for at in attach_meta['feed']['entry']:
-            x_attach_size = None
-            for attach in at['link']:
-                if attach['@rel'] == 'enclosure':
-                    x_attach_size = attach['@length']
+pages_collected = 0
 
-            attachment_info.append({'content': at['content']['@src']
-                                       , 'type': at['content']['@type']
-                                       , 'title': at['title']['#text']
-                                       , 'size_bytes': x_attach_size
-                                       , 'size_human': wiki_meta.convertSize(x_attach_size)})
 
+def fetch_page_attachments(x):
+    # download attachment metadata as a stream, same as the index feed
+    attach_data = w3_session.get(x['attachments'], stream=True)
+    attach_data.raw.decode_content = True
+    attach_xml = XmlWorker(attach_data.raw)
+    # setup empty list to hold dictionaries of the attachment metadata
+    # iterating entries handles zero, one or many attachments with one code path
+    # so the old duplicated one-vs-many parsing is gone
+    attachment_info = []
+    for at in attach_xml.iterAttachmentEntries():
+        attachment_info.append({'content': at['content']
+                                   , 'type': at['type']
+                                   , 'title': at['title']
+                                   , 'size_bytes': at['size_bytes']
+                                   , 'size_human': wiki_meta.convertSize(at['size_bytes'])})
+    logger.debug("{} -- Num of attachments: {}".format(x['title'], len(attachment_info)))
+    return attachment_info
+
+
+def fetch_page_comments(x):
+    # download comment metadata
+    comment_data = wiki_meta.get_wiki_page_comments(wiki_second_id, x['page_id'])
+    comment_xml = XmlWorker(comment_data)
+    # make the metadata into a dictionary
+    comment_meta = comment_xml.getDict()
+    # setup empty list to hold dictionaries of the attachment metadata
+    comment_info = []
+    num_of_comments = comment_meta['feed']['opensearch:totalResults']
+    logger.debug("{} -- Num of comments: {}".format(x['title'], num_of_comments))
+
+    # entry_list flattens the one-vs-many XML quirk into a single path
+    for at in entry_list(comment_meta['feed']):
+        # fromisoformat is a C parser, much quicker than strptime's format
+        # machinery - the Z swap keeps it happy on pythons before 3.11
+        comment_info.append({'author': at['author']['name']
+                                , 'published': datetime.fromisoformat(at['published'].replace('Z', '+00:00'))
+                                , 'content': at['content']['#text']})
+
+    return comment_info
+
+
+def collect_page_metadata(x):
+    # one worker handles all three endpoints for a page back-to-back, so the
+    # page list only gets walked (and scheduled) once instead of three times
+    global pages_collected
+    nav = NavigationWorker(x['page_id'], wiki_second_id)
+    parent_id = nav.get_parent_id(w3_session)
+    attachment_info = fetch_page_attachments(x)
+    comment_info = fetch_page_comments(x) if collect_comments else []
+    with progress_lock:
+        pages_collected += 1
+        if pages_collected % 20 == 0:
+            logger.info("Collected metadata for {} pages so far".format(pages_collected))
+    return parent_id, attachment_info, comment_info
+
+
+# run the combined pass in parallel and fill everything in on the main thread
+for x, (parent_id, attachment_info, comment_info) in zip(
+        pages_to_download, fetch_pool.map(collect_page_metadata, pages_to_download)):
+    x['parent_id'] = parent_id
+    if len(attachment_info) > 0:
         attachments_to_download[x['page_id']] = attachment_info
+    if len(comment_info) > 0:
+        wiki_comment_data[x['page_id']] = comment_info
 
 logger.info("Searched {} pages for attachments, {} pages with attachments".format(number_of_pages_to_download,
                                                                                   len(attachments_to_download)))
-
-if sync_to_confluence and append_wiki_comments:
-    logger.info("#" * 20)
-    logger.info("Looking for comments on pages")
-    logger.info("#" * 20)
-
-    wiki_comment_data = {}
-
-    # start searching for comments on the pages collected
-    for i, x in enumerate(pages_to_download):
-        if i % 20 == 0 and i != 0:
-            logger.info(
-                "Searched {} pages for comments so far, {} pages with comments".format(i, len(wiki_comment_data)))
-        # download comment metadata
-        comment_data = wiki_meta.get_wiki_page_comments(wiki_second_id, x['page_id'])
-        comment_xml = XmlWorker(comment_data)
-        # make the metadata into a dictionary
-        comment_meta = comment_xml.getDict()
-        # setup empty list to hold dictionaries of the attachment metadata
-        comment_info = []
-        num_of_comments = comment_meta['feed']['opensearch:totalResults']
-        logger.debug("{} -- Num of comments: {}".format(x['title'], num_of_comments))
-
-        # Ughh, the W3 XML changes if there is exactly one comment
-        # Duplicating some code here, come back and cleanup later :(
-        if num_of_comments == '1':
-            at = comment_meta['feed']['entry']
-            comment_info.append({'author': at['author']['name']
-                                    , 'published': datetime.strptime(at['published'], "%Y-%m-%dT%H:%M:%S.%fZ")
-                                    , 'content': at['content']['#text']})
-
-            wiki_comment_data[x['page_id']] = comment_info
-
-        # # assumes there is more than one attachment
-        elif num_of_comments not in ['0', '1']:
-            for at in comment_meta['feed']['entry']:
-                comment_info.append({'author': at['author']['name']
-                                        , 'published': datetime.strptime(at['published'], "%Y-%m-%dT%H:%M:%S.%fZ")
-                                        , 'content': at['content']['#text']})
-
-            wiki_comment_data[x['page_id']] = comment_info
-
+if collect_comments:
     logger.info("Searched {} pages for comments, {} pages with comments".format(number_of_pages_to_download,
                                                                                 len(wiki_comment_data)))
 
-# setup local copy directory under wikibackup folder and enter it
+# setup local copy directory under wikibackup folder
+# everything below builds absolute paths off local_wiki_directory, so the
+# process cwd never needs to change - chdir is global state the pool
+# threads would all share
 script_directory = os.getcwd()
 local_wiki_directory = os.path.join(script_directory, 'wikibackup', wiki_title)
 os.makedirs(local_wiki_directory, exist_ok=True)
-os.chdir(local_wiki_directory)
 
 logger.info("#" * 20)
 logger.info("Putting wiki files in {}".format(local_wiki_directory))
@@ -640,49 +700,164 @@ confluence_page_mapping = {}
 
 
 def find_attachment_file_in_list(page_id, file_name):
-    conf_att_id = None
-    for m in conf_attachment_mapping:
-        if m['page_id'] == page_id and m['file_name'] == file_name:
-            conf_att_id = m['attach_id']
-
-    return conf_att_id
+    return conf_attachment_mapping.get((str(page_id), file_name))
 
 
-attachments_formatted = []
+# set, not list - ids land here once per replacement and the later
+# membership test in the parent-update loop should be O(1)
+attachments_formatted = set()
 
 possible_link_issues = {}
 
+# these confluence macro fragments must go through html.parser - the lxml
+# backends strip the undeclared ac:/ri: prefixes (and dissolve CDATA), which
+# silently turns the macros into tags confluence doesn't recognize
+
+# the Confluence TOC macro markup never changes, so build it once up front
+soup_toc_template = BeautifulSoup("""<p>
+  <ac:structured-macro ac:name="toc" ac:schema-version="1"/>
+</p>""", 'html.parser')
+
+# same idea for the image markup - clone this per replaced image rather than
+# rebuilding both tags through new_tag each time
+soup_image_template = BeautifulSoup(
+    '<ac:image><ri:attachment ri:filename=""/></ac:image>', 'html.parser').find('ac:image')
+
+# the two ac:link flavors get the same treatment - parse the skeleton once and
+# clone per replaced link instead of formatting a string and re-parsing it
+soup_attach_link_template = BeautifulSoup(
+    '<ac:link><ri:attachment ri:filename=""/>'
+    '<ac:plain-text-link-body></ac:plain-text-link-body></ac:link>', 'html.parser').find('ac:link')
+soup_page_link_template = BeautifulSoup(
+    '<ac:link><ri:page ri:content-title=""/>'
+    '<ac:plain-text-link-body></ac:plain-text-link-body></ac:link>', 'html.parser').find('ac:link')
+
+# fail at startup rather than on the first replaced link if a parser change
+# ever mangles the prefixed tag names again
+assert soup_image_template is not None \
+       and soup_attach_link_template is not None \
+       and soup_page_link_template is not None \
+       and soup_toc_template.find('ac:structured-macro') is not None, \
+    "confluence macro templates did not parse - check the fragment parser"
+
+
+def fill_link_template(template, ref_tag, ref_attr, ref_value, link_text):
+    new_link = copy.copy(template)
+    new_link.find(ref_tag)[ref_attr] = ref_value
+    new_link.find('ac:plain-text-link-body').append(CData(link_text))
+    return new_link
+
+
+def save_page_html(download_url, file_path):
+    # stream the page HTML straight to its backup file instead of buffering it all
+    with w3_session.get(download_url, stream=True) as pd:
+        pd.raw.decode_content = True
+        with open(file_path, 'wb') as f:
+            shutil.copyfileobj(pd.raw, f, length=1024 * 1024)
+
+
+def download_attachment(page_title, fi):
+    logger.info('    Downloading {} || size - {}'.format(fi['title'], fi['size_human']))
+    file_path = os.path.join(local_wiki_directory, page_title, fi['title'])
+    # stream straight to disk in 1MB chunks so a big attachment never sits in memory
+    with w3_session.get(fi['content'], stream=True) as ad:
+        ad.raw.decode_content = True
+        with open(file_path, 'wb') as f:
+            shutil.copyfileobj(ad.raw, f, length=1024 * 1024)
+    return file_path
+
+
+# the connections-file entry only has three fields we care about, so pull them
+# straight out with lxml rather than converting the whole document to a dict
+conn_entry_ns = {'atom': 'http://www.w3.org/2005/Atom', 'td': 'urn:ibm.com/td'}
+
+
+def get_connections_file_meta(conn_uuid):
+    # metadata XML fetch for one linked connections file, safe to run on a pool thread
+    # returns the bits we need or the exception so the main thread can decide what to do
+    try:
+        conn_link = w3_session.get(
+            "{}/files/basic/anonymous/api/document/{}/entry".format(w3_host, conn_uuid))
+        logger.debug(conn_link.text)
+        conn_entry = etree.fromstring(conn_link.content)
+        conn_meta = {'url': conn_entry.find('atom:content', conn_entry_ns).get('src')
+            , 'title': conn_entry.findtext('td:label', namespaces=conn_entry_ns)
+            , 'size': conn_entry.findtext('td:versionMediaSize', namespaces=conn_entry_ns)}
+        # findtext hands back None for missing elements where the old dict
+        # lookups raised - surface incomplete entries as the error case so the
+        # main thread alerts and skips instead of blowing up on the size math
+        if None in conn_meta.values():
+            raise ValueError("connections file entry is missing content/label/size")
+        # a malformed size should fail here inside the try, not on the main thread
+        int(conn_meta['size'])
+        return conn_meta
+    except Exception as e:
+        return {'error': e}
+
+
+def download_connections_file(page_title, conf_page_id, conn_meta):
+    # streamed download plus confluence upload for one connections file,
+    # also safe on a pool thread - all paths are absolute
+    try:
+        # make a directory specific to connections files
+        # in case there are names already used by attachments to the page in W3
+        conn_dir = os.path.join(local_wiki_directory, page_title, 'connections_files')
+        os.makedirs(conn_dir, exist_ok=True)
+        conn_file_path = os.path.join(conn_dir, conn_meta['title'])
+        # stream straight to disk so a big file never sits whole in memory
+        with w3_session.get(conn_meta['url'], stream=True) as cf:
+            cf.raise_for_status()
+            cf.raw.decode_content = True
+            with open(conn_file_path, 'wb') as f:
+                shutil.copyfileobj(cf.raw, f, length=1 << 20)
+        create_conf_attachment(conf_page_id, conn_meta['title'], conn_file_path)
+        return None
+    except Exception as e:
+        return e
+
+# kick off every page download up front - the HTML lands on disk while the
+# main loop is busy parsing and talking to confluence, so by the time a page
+# comes around its fetch is usually already done
+# absolute paths everywhere - no chdir/getcwd syscalls in the hot loop, and
+# the worker threads all see the same paths regardless of process cwd
+page_html_paths = {}
+page_fetch_futures = {}
+for page in pages_to_download:
+    page_dir = os.path.join(local_wiki_directory, page['title'])
+    os.makedirs(page_dir, exist_ok=True)
+    page_html_paths[page['page_id']] = os.path.join(page_dir, 'index.html')
+    page_fetch_futures[page['page_id']] = fetch_pool.submit(
+        save_page_html, page['download_url'], page_html_paths[page['page_id']])
+
 # create folders for each page and download pages/attachments into the folder
 for i, page in enumerate(pages_to_download):
     conf_page_id = None
-    os.chdir(local_wiki_directory)
-    os.makedirs(page['title'], exist_ok=True)
-    pd = requests.get(page['download_url'], cookies=cookies, headers=headers)
+    page_html_path = page_html_paths[page['page_id']]
     logger.info("({}/{}) Downloading HTML for {}".format(i + 1, number_of_pages_to_download, page['title']))
-    with open(os.path.join(os.getcwd(), page['title'], 'index.html'), 'wb') as f:
-        f.write(pd.content)
+    # wait for this page's prefetch (also surfaces any download error here)
+    page_fetch_futures[page['page_id']].result()
 
     if sync_to_confluence:
-        soup = BeautifulSoup(pd.content, 'html.parser')
+        # only pull the saved copy back into memory when we actually parse it
+        # lxml is the C-backed parser, several times faster than html.parser here
+        with open(page_html_path, 'rb') as f:
+            soup = BeautifulSoup(f.read(), 'lxml')
         # need to remove some items that cause fits for Confluence xhtml parser
-        for meta in soup.find_all('meta'):
-            meta.decompose()
-        for colon in soup.find_all(re.compile(":")):
-            # i've seen <v:rect> and <o:p> tags in W3 and Confluence hates them
-            # so let's just remove any tag that contains a colon because that means it's not valid HTML
-            # we'll add tags with colons later, but those are Confluence macros that they understand as valid
-            # https://developer.mozilla.org/en-US/docs/Web/HTML/Element
-            logger.info("Removing this code because the tag contains a colon: \n{}".format(colon.prettify()))
-            colon.decompose()
+        # i've seen <v:rect> and <o:p> tags in W3 and Confluence hates them
+        # so let's just remove any tag that contains a colon because that means it's not valid HTML
+        # we'll add tags with colons later, but those are Confluence macros that they understand as valid
+        # https://developer.mozilla.org/en-US/docs/Web/HTML/Element
+        # one regex covers meta and the colon tags so the tree is only walked once
+        for bad_tag in soup.find_all(re.compile(r'^meta$|:')):
+            if ':' in bad_tag.name:
+                logger.info("Removing this code because the tag contains a colon: \n{}".format(bad_tag.prettify()))
+            bad_tag.decompose()
 
         if append_w3_history_table:
-            w3_stats_info = [page['author'], page['created'], page['modifier'], page['modified'], page['link']]
-            td_markup = ""
-            for i, m in enumerate(w3_stats_info):
-                if i != len(w3_stats_info) - 1:
-                    td_markup = td_markup + "<td>" + m + "</td>"
-                else:
-                    td_markup = td_markup + "<td><a href='" + m + "' target='_blank'>Link</a></td>"
+            w3_stats_info = [page['author'], page['created'], page['modifier'], page['modified']]
+            # join the cells in one go instead of growing the string cell by cell
+            td_markup = ''.join("<td>{}</td>".format(m) for m in w3_stats_info) \
+                        + "<td><a href='{}' target='_blank'>Link</a></td>".format(page['link'])
             append_to_markup = """<hr/><b>Original W3 Page Metadata</b><br/><table>
                 <colgroup><col/><col/><col/><col/><col/></colgroup>
                 <tbody>
@@ -693,29 +868,29 @@ for i, page in enumerate(pages_to_download):
                     <th>Modified</th>
                     <th>W3 Link</th>
                   </tr>
-                  <tr>""" + td_markup + """
+                  <tr>{}
                   </tr>
                 </tbody>
-              </table>"""
+              </table>""".format(td_markup)
 
-            soup_to_append = BeautifulSoup(append_to_markup, 'html.parser')
-
-            soup.body.append(soup_to_append)
+            # lxml wraps fragments in html/body, so move just the real content over
+            soup_to_append = BeautifulSoup(append_to_markup, 'lxml')
+            for fragment in list(soup_to_append.body.children):
+                soup.body.append(fragment)
 
         if append_wiki_comments and page['page_id'] in wiki_comment_data:
             page_comments = wiki_comment_data[page['page_id']]
-            td_markup = ""
             # this sorts the comments in the order they were published
             sortedArray = sorted(
                 page_comments,
                 key=lambda x: x['published'], reverse=False
             )
+            # collect whole rows and join once - long comment threads made the
+            # old += concatenation quadratic
+            comment_rows = []
             for c in sortedArray:
-                td_markup = td_markup + "<tr>"
                 w3_comments = [c['author'], c['published'].strftime("%m/%d/%Y %H:%M:%S"), c['content']]
-                for i, m in enumerate(w3_comments):
-                    td_markup = td_markup + "<td>" + str(m) + "</td>"
-                td_markup = td_markup + "</tr>"
+                comment_rows.append("<tr>{}</tr>".format(''.join("<td>{}</td>".format(m) for m in w3_comments)))
             append_to_markup = """<p><b>Original W3 Comments</b><br/><table>
                 <colgroup><col/><col/><col/></colgroup>
                 <tbody>
@@ -723,33 +898,29 @@ for i, page in enumerate(pages_to_download):
                     <th>Author</th>
                     <th>Published</th>
                     <th>Comment</th>
-                  </tr>""" + td_markup + """
+                  </tr>{}
                 </tbody>
-              </table></p>"""
-
-            soup_comments_to_append = BeautifulSoup(append_to_markup, 'html.parser')
+              </table></p>""".format(''.join(comment_rows))
 
-            soup.body.append(soup_comments_to_append)
+            soup_comments_to_append = BeautifulSoup(append_to_markup, 'lxml')
+            for fragment in list(soup_comments_to_append.body.children):
+                soup.body.append(fragment)
 
         if replace_table_of_contents:
-            soup_toc_to_append = BeautifulSoup("""<p>
-              <ac:structured-macro ac:name="toc" ac:schema-version="1"/>
-            </p>""", 'html.parser')
-
             for toc in soup.find_all('div', attrs={'name': 'intInfo'}):
-                found_toc_in_loop = False
-                for i, strs in enumerate(toc.stripped_strings):
-                    # the string 'Table of Contents:' should be one of the stripped strings if it's a W3 TOC
-                    if strs == 'Table of Contents:':
-                        found_toc_in_loop = True
-                if found_toc_in_loop:
-                    # need to replace after the stripped strings loop because we get an error otherwise
-                    # since we'd be replacing soup that is still being parsed
+                # the text 'Table of Contents:' marks a W3 TOC - let BS4 search
+                # for that one node and bail early instead of generating stripped
+                # strings for the whole subtree
+                if toc.find(string=lambda s: s.strip() == 'Table of Contents:') is not None:
+                    # copy the template so each replacement gets its own node
                     logger.info("Replacing W3 Table of Contents")
-                    toc.replace_with(soup_toc_to_append)
+                    toc.replace_with(copy.copy(soup_toc_template))
 
-        logger.debug(soup.prettify())
-        conf_page_id = create_conf_page(page['title'], soup.prettify(), homepage_id)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(soup.prettify())
+        # str(soup) carries the same markup as prettify without the indentation
+        # walk, which Confluence strips anyway
+        conf_page_id = create_conf_page(page['title'], str(soup), homepage_id)
         confluence_page_mapping[page['page_id']] = {'w3_parent_id': page['parent_id']
             , 'conf_page_id': conf_page_id
             , 'page_title': page['title']}
@@ -763,14 +934,18 @@ for i, page in enumerate(pages_to_download):
 
     # only try to get attachments if they exist for a page id
     if page['page_id'] in attachments_to_download.keys():
-        for fi in attachments_to_download[page['page_id']]:
-            logger.info('    Downloading {} || size - {}'.format(fi['title'], fi['size_human']))
-            ad = requests.get(fi['content'], cookies=cookies, headers=headers)
-            with open(os.path.join(os.getcwd(), page['title'], fi['title']), 'wb') as f:
-                f.write(ad.content)
+        page_attachments = attachments_to_download[page['page_id']]
 
-            if sync_to_confluence and int(conf_page_id) > 0:
-                create_conf_attachment(conf_page_id, fi['title'], os.path.join(os.getcwd(), page['title'], fi['title']))
+        # a page can have dozens of attachments and the downloads are all
+        # independent, so fan them out on the shared pool
+        attachment_paths = list(fetch_pool.map(
+            lambda fi: download_attachment(page['title'], fi), page_attachments))
+
+        if sync_to_confluence and int(conf_page_id) > 0:
+            # then the uploads, also in parallel once the files are all on disk
+            list(fetch_pool.map(
+                lambda fi_path: create_conf_attachment(conf_page_id, fi_path[0]['title'], fi_path[1]),
+                zip(page_attachments, attachment_paths)))
 
         if sync_to_confluence and int(conf_page_id) > 0:
             logger.info("Looking for images to replace")
@@ -782,76 +957,94 @@ for i, page in enumerate(pages_to_download):
                     found_attach_id = find_attachment_file_in_list(conf_page_id, image_file_name)
                     if found_attach_id is not None:
                         images_found_to_replace += 1
-                        attachments_formatted.append(conf_page_id)
-                        new_tag = soup.new_tag("ac:image")
-                        conf_image_ref = soup.new_tag("ri:attachment")
-                        conf_image_ref['ri:filename'] = image_file_name
-                        new_tag.append(conf_image_ref)
+                        attachments_formatted.add(conf_page_id)
+                        new_tag = copy.copy(soup_image_template)
+                        new_tag.find('ri:attachment')['ri:filename'] = image_file_name
                         image_src.replace_with(new_tag)
                         logger.info(
                             "-- Image attachment formatted to Confluence markup in HTML: {}".format(found_attach_id))
 
-            logger.info("Looking for link attachments to replace")
-            for link_src in soup.find_all('a', attrs={"lconnwikiparamwikiattachment": True}):
+    if sync_to_confluence:
+        # one walk over every anchor on the page instead of four separate
+        # find_all passes - each link is classified once, replaced at most once,
+        # and anything left unreplaced still gets the link-issues check,
+        # same as when the scans ran back to back
+        logger.info("Scanning page links for attachments, wiki links, connections files and issues")
+        replace_attachment_links = page['page_id'] in attachments_to_download.keys() \
+                                   and int(conf_page_id) > 0
+        link_issues_data = []
+        # connections-file links get collected here and handled in parallel after
+        # the walk - the fetches are all independent network waits
+        conn_link_nodes = []
+        for link_src in soup.find_all('a'):
+            link_attrs = link_src.attrs
+            replaced_link = False
+            if replace_attachment_links and 'lconnwikiparamwikiattachment' in link_attrs:
                 href_of_link = link_src['lconnwikiparamwikiattachment']
                 a_link_text = link_src.text
                 found_attach_id = find_attachment_file_in_list(conf_page_id, href_of_link)
                 if found_attach_id is not None:
                     links_found_to_replace += 1
-                    attachments_formatted.append(conf_page_id)
-                    link_replace_html = """<ac:link>
-                <ri:attachment ri:filename="{}"/>
-                <ac:plain-text-link-body><![CDATA[{}]]></ac:plain-text-link-body>
-              </ac:link>""".format(href_of_link, a_link_text)
-                    wiki_attach_link_soup = BeautifulSoup(link_replace_html, 'html.parser')
-                    link_src.replace_with(wiki_attach_link_soup)
+                    attachments_formatted.add(conf_page_id)
+                    link_src.replace_with(fill_link_template(
+                        soup_attach_link_template, 'ri:attachment', 'ri:filename', href_of_link, a_link_text))
+                    replaced_link = True
                     logger.info("-- Link attachment formatted to Confluence markup in HTML: {}".format(found_attach_id))
-
-    if sync_to_confluence and replace_w3_wiki_links:
-        logger.info("Looking for wiki links to replace")
-        for link_src in soup.find_all('a', attrs={"lconnwikiparamwikipage": True}):
-            href_of_link = link_src['lconnwikiparamwikipage']
-            a_link_text = link_src.text
-            wiki_links_found_to_replace += 1
-            attachments_formatted.append(conf_page_id)
-            reformatted_link = """<ac:link>
-                  <ri:page ri:content-title="{}"/>
-                  <ac:plain-text-link-body><![CDATA[{}]]></ac:plain-text-link-body>
-                </ac:link>""".format(href_of_link, a_link_text)
-            wiki_link_soup_to_append = BeautifulSoup(reformatted_link, 'html.parser')
-            link_src.replace_with(wiki_link_soup_to_append)
-            logger.info("-- Wiki link formatted to Confluence markup in HTML: {}".format(href_of_link))
-
-    if sync_to_confluence and replace_w3_wiki_links:
-        for link_src in soup.find_all('a', attrs={"wiki": True, "page": True}):
-            if link_src['wiki'] == w3_wiki_id:
+            elif replace_w3_wiki_links and 'lconnwikiparamwikipage' in link_attrs:
+                href_of_link = link_src['lconnwikiparamwikipage']
+                a_link_text = link_src.text
+                wiki_links_found_to_replace += 1
+                attachments_formatted.add(conf_page_id)
+                link_src.replace_with(fill_link_template(
+                    soup_page_link_template, 'ri:page', 'ri:content-title', href_of_link, a_link_text))
+                replaced_link = True
+                logger.info("-- Wiki link formatted to Confluence markup in HTML: {}".format(href_of_link))
+            elif replace_w3_wiki_links and 'wiki' in link_attrs and 'page' in link_attrs \
+                    and link_src['wiki'] == w3_wiki_id:
                 href_of_link = link_src['page']
                 a_link_text = link_src.text
                 old_wiki_links_found_to_replace += 1
-                attachments_formatted.append(conf_page_id)
-                reformatted_link = """<ac:link>
-                      <ri:page ri:content-title="{}"/>
-                      <ac:plain-text-link-body><![CDATA[{}]]></ac:plain-text-link-body>
-                    </ac:link>""".format(href_of_link, a_link_text)
-                wiki_link_soup_to_append = BeautifulSoup(reformatted_link, 'html.parser')
-                link_src.replace_with(wiki_link_soup_to_append)
+                attachments_formatted.add(conf_page_id)
+                link_src.replace_with(fill_link_template(
+                    soup_page_link_template, 'ri:page', 'ri:content-title', href_of_link, a_link_text))
+                replaced_link = True
                 logger.info("-- Older Wiki link formatted to Confluence markup in HTML: {}".format(href_of_link))
-
-    if sync_to_confluence and replace_connections_files:
-        logger.info("Looking for linked connection files to download")
-        for link_src in soup.find_all('a', attrs={"_ic_files_uuid": True}):
-            href_of_link = link_src['_ic_files_uuid']
-            logger.info("-- Found connection file id {}, getting details".format(href_of_link))
-            a_link_text = link_src.text
-            try:
-                conn_link = requests.get("{}/files/basic/anonymous/api/document/{}/entry".format(w3_host, href_of_link),
-                                         cookies=cookies, headers=headers)
-                logger.debug(conn_link.text)
-                conn_details = XmlWorker(conn_link.text)
-                conn_meta = conn_details.getDict()
-                conn_file_url = conn_meta['entry']['content']['@src']
-                conn_file_title = conn_meta['entry']['td:label']
-                conn_file_size = conn_meta['entry']['td:versionMediaSize']
+            elif replace_connections_files and '_ic_files_uuid' in link_attrs:
+                logger.info("-- Found connection file id {}, getting details".format(link_src['_ic_files_uuid']))
+                # defer - the network work runs on the pool below, and the
+                # issues check happens there too for anything left unreplaced
+                conn_link_nodes.append(link_src)
+                continue
+            # anything that survived untouched can still be a questionable IBM/box link
+            if not replaced_link and find_possible_link_issues and 'href' in link_attrs:
+                href_of_link = link_src['href']
+                if href_of_link != page['link'] and ('ibm' in href_of_link or 'box.com' in href_of_link):
+                    a_link_text = unicodedata.normalize("NFKD", link_src.text)
+                    logger.info("-- Found URL: {}".format(href_of_link))
+                    link_issues_data.append({'url': href_of_link, 'text': a_link_text})
+
+        replaced_conn_nodes = set()
+        if len(conn_link_nodes) > 0:
+            # the metadata fetches are independent, so do them all at once
+            conn_uuids = [n['_ic_files_uuid'] for n in conn_link_nodes]
+            conn_metas = list(fetch_pool.map(get_connections_file_meta, conn_uuids))
+
+            # decide on the main thread, in page order, which files to take
+            conn_jobs = []
+            # set when a connections file had to be skipped so we stop trying the rest
+            skip_connections_files = False
+            for link_src, conn_uuid, conn_meta in zip(conn_link_nodes, conn_uuids, conn_metas):
+                if 'error' in conn_meta:
+                    logger.info("Could not retrieve/upload Connections file. See log for more details")
+                    alert_items.append(
+                        "Had issues downloading/uploading connections file id '{}' on page '{}'".format(
+                            conn_uuid, page['title'], ))
+                    logger.error(conn_meta['error'], exc_info=logger.getEffectiveLevel() == logging.DEBUG)
+                    continue
+                if skip_connections_files:
+                    continue
+                conn_file_title = conn_meta['title']
+                conn_file_size = conn_meta['size']
                 logger.info("-- Connections file named '{}' is size {}".
                             format(conn_file_title, wiki_meta.convertSize(conn_file_size)))
                 # Need to capture the rare scenario where a connections file name is already attached to the page
@@ -862,29 +1055,40 @@ for i, page in enumerate(pages_to_download):
                     alert_items.append(
                         "Had to skip downloading connections file {} on page {} as an attachment already exists for it".format(
                             conn_file_title, page['title']))
-                    break
+                    # was a break out of the old connections loop - now just
+                    # stop handling connections files for the rest of this page
+                    skip_connections_files = True
                 # only attempt if file is under confluence attachment size limit
-                if int(conn_file_size) < conf_max_attachment_size:
+                elif int(conn_file_size) < conf_max_attachment_size:
                     logger.info("    Downloading {} bytes, please wait".format(conn_file_size))
-                    os.chdir(os.path.join(local_wiki_directory, page['title']))
-                    os.makedirs('connections_files', exist_ok=True)
-                    cf = requests.get(conn_file_url, cookies=cookies, headers=headers)
-                    # make a directory specific to connections files
-                    # in case there are names already used by attachments to the page in W3
-                    with open(os.path.join(local_wiki_directory, page['title'], 'connections_files', conn_file_title),
-                              'wb') as f:
-                        f.write(cf.content)
-                    create_conf_attachment(conf_page_id, conn_file_title,
-                                           os.path.join(local_wiki_directory, page['title'], 'connections_files',
-                                                        conn_file_title))
-                    os.chdir(local_wiki_directory)
+                    conn_jobs.append((link_src, conn_uuid, conn_meta))
+                else:
+                    logger.info(
+                        "    Unable to download a file of that size as the Confluence limit is {} bytes, skipping".format(
+                            conf_max_attachment_size))
+                    alert_items.append(
+                        "Had to skip downloading connections file '{}' of {} bytes on page '{}' as it exceeds {} bytes. URL: {}".format(
+                            conn_file_title, conn_file_size, page['title'], conf_max_attachment_size, conn_meta['url']))
+
+            if len(conn_jobs) > 0:
+                # download and upload the keepers in parallel, then mutate the
+                # soup back on the main thread - bs4 mutation isn't thread-safe
+                conn_errors = list(fetch_pool.map(
+                    lambda job: download_connections_file(page['title'], conf_page_id, job[2]), conn_jobs))
+                for (link_src, conn_uuid, conn_meta), conn_error in zip(conn_jobs, conn_errors):
+                    if conn_error is not None:
+                        logger.info("Could not retrieve/upload Connections file. See log for more details")
+                        alert_items.append(
+                            "Had issues downloading/uploading connections file id '{}' on page '{}'".format(
+                                conn_uuid, page['title'], ))
+                        logger.error(conn_error, exc_info=logger.getEffectiveLevel() == logging.DEBUG)
+                        continue
+                    conn_file_title = conn_meta['title']
+                    a_link_text = link_src.text
                     connection_links_found_to_replace += 1
-                    attachments_formatted.append(conf_page_id)
-                    reformatted_link = """<ac:link>
-                      <ri:attachment ri:filename="{}"/>
-                      <ac:plain-text-link-body><![CDATA[{}]]></ac:plain-text-link-body>
-                    </ac:link>""".format(conn_file_title, a_link_text)
-                    wiki_link_soup_to_append = BeautifulSoup(reformatted_link, 'html.parser')
+                    attachments_formatted.add(conf_page_id)
+                    wiki_link_soup_to_append = fill_link_template(
+                        soup_attach_link_template, 'ri:attachment', 'ri:filename', conn_file_title, a_link_text)
                     # By default, W3 Connection file links have extra HTML (a divider and a view details link)
                     # that we want to get rid of as they serve no purpose in Confluence
                     # Put this in try/except block because it's not important enough to break everything
@@ -893,66 +1097,54 @@ for i, page in enumerate(pages_to_download):
                             if isinstance(sibling, NavigableString):
                                 pass
                             else:
+                                # .get collapses the has_attr + subscript double lookup
                                 if sibling.name == 'span':
-                                    if sibling.has_attr('class'):
-                                        if 'lotusDivider' in sibling['class']:
-                                            sibling.decompose()
-                                            logger.info("Removed superfluous connections link divider")
+                                    if 'lotusDivider' in (sibling.get('class') or ()):
+                                        sibling.decompose()
+                                        logger.info("Removed superfluous connections link divider")
                                 if sibling.name == 'a':
-                                    if sibling.has_attr('title'):
-                                        if 'View details of {}'.format(conn_file_title) in sibling['title']:
-                                            sibling.decompose()
-                                            logger.info("Removed superfluous connections link view details")
+                                    sibling_title = sibling.get('title')
+                                    if sibling_title and 'View details of {}'.format(conn_file_title) in sibling_title:
+                                        sibling.decompose()
+                                        logger.info("Removed superfluous connections link view details")
                     except Exception as e:
                         logger.info(
                             "Had issue cleaning up superfluous W3 Connections link HTML. See log for more details")
                         logger.error(e, exc_info=logger.getEffectiveLevel() == logging.DEBUG)
                     link_src.replace_with(wiki_link_soup_to_append)
+                    replaced_conn_nodes.add(id(link_src))
                     logger.info(
                         "Connections file link formatted to Confluence markup in HTML: {}".format(conn_file_title))
-                else:
-                    logger.info(
-                        "    Unable to download a file of that size as the Confluence limit is {} bytes, skipping".format(
-                            conf_max_attachment_size))
-                    alert_items.append(
-                        "Had to skip downloading connections file '{}' of {} bytes on page '{}' as it exceeds {} bytes. URL: {}".format(
-                            conn_file_title, conn_file_size, page['title'], conf_max_attachment_size, conn_file_url))
-            except Exception as e:
-                logger.info("Could not retrieve/upload Connections file. See log for more details")
-                alert_items.append(
-                    "Had issues downloading/uploading connections file id '{}' on page '{}'".format(
-                        href_of_link, page['title'], ))
-                logger.error(e, exc_info=logger.getEffectiveLevel() == logging.DEBUG)
-
-    if sync_to_confluence and find_possible_link_issues:
-        link_issues_found = 0
-        logger.info("Looking for random IBM links that might cause future issues")
-        link_issues_data = []
-        for link_src in soup.find_all('a', attrs={"href": True}):
-            href_of_link = link_src['href']
-            if ('ibm' in href_of_link or 'box.com' in href_of_link) and href_of_link != page['link']:
-                link_issues_found += 1
-                a_link_text = unicodedata.normalize("NFKD", link_src.text)
-                logger.info("-- Found URL: {}".format(href_of_link))
-                link_issues_data.append({'url': href_of_link, 'text': a_link_text})
-        if link_issues_found > 0:
+
+            # connections links that didn't get replaced still deserve the issues check
+            if find_possible_link_issues:
+                for link_src in conn_link_nodes:
+                    if id(link_src) in replaced_conn_nodes or 'href' not in link_src.attrs:
+                        continue
+                    href_of_link = link_src['href']
+                    if href_of_link != page['link'] and ('ibm' in href_of_link or 'box.com' in href_of_link):
+                        a_link_text = unicodedata.normalize("NFKD", link_src.text)
+                        logger.info("-- Found URL: {}".format(href_of_link))
+                        link_issues_data.append({'url': href_of_link, 'text': a_link_text})
+
+        if len(link_issues_data) > 0:
             possible_link_issues[page['page_id']] = link_issues_data
 
     if images_found_to_replace > 0 or links_found_to_replace > 0 \
             or wiki_links_found_to_replace > 0 or connection_links_found_to_replace > 0 \
             or old_wiki_links_found_to_replace > 0:
         logger.info("Updating confluence page with image/link sources")
-        confluence.update_page(conf_page_id, page['title'], soup.prettify())
+        # plain serialization - confluence strips the indentation prettify
+        # spends its time producing anyway
+        confluence.update_page(conf_page_id, page['title'], str(soup))
 
     logger.info("#" * 20)
 
 
 def getConfIdFromW3Id(w3_p_id):
-    p_id = None
-    for c in confluence_page_mapping.keys():
-        if c == w3_p_id:
-            p_id = confluence_page_mapping[w3_p_id]['conf_page_id']
-    return p_id
+    # the mapping is already keyed by w3 page id, so this is a plain dict hit
+    mapping_entry = confluence_page_mapping.get(w3_p_id)
+    return mapping_entry['conf_page_id'] if mapping_entry else None
 
 
 if sync_to_confluence:
@@ -961,50 +1153,61 @@ if sync_to_confluence:
     # because the atlassian module method for update_page requires a body
     # and we only want to update the parent id
     s = requests.Session()
-    conf_headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+    # the PUTs are tiny, so keep a handful of sockets warm and reuse them
+    s.mount('https://', HTTPAdapter(pool_maxsize=16))
+    # cookies and headers live on the session - merging them per request
+    # builds fresh dicts inside requests every time for no reason
+    s.headers.update({'Content-Type': 'application/json', 'Accept': 'application/json'})
+    s.cookies.update(conf_cookies)
 
     # need to update the dictionary to include the parent conf id for each conf page created
-    for cid in confluence_page_mapping.keys():
-        parent_w3_id = confluence_page_mapping[cid]['w3_parent_id']
-        confluence_page_mapping[cid]['conf_parent_id'] = getConfIdFromW3Id(parent_w3_id)
-
-    for i, ids in enumerate(confluence_page_mapping.keys()):
-        if i % 20 == 0 and i != 0:
-            logger.info("Updated {}/{} Confluence parent ids so far".format(i, number_of_pages_to_download))
-        child_conf_id = confluence_page_mapping[ids]['conf_page_id']
-        parent_conf_id = confluence_page_mapping[ids]['conf_parent_id']
-        page_title = confluence_page_mapping[ids]['page_title']
-        vers_num = 2
+    for page_meta in confluence_page_mapping.values():
+        page_meta['conf_parent_id'] = getConfIdFromW3Id(page_meta['w3_parent_id'])
+
+    # collect the updates first, then fire them in parallel - each PUT is
+    # independent and mostly waits on confluence
+    parent_updates = []
+    for page_meta in confluence_page_mapping.values():
+        child_conf_id = page_meta['conf_page_id']
+        parent_conf_id = page_meta['conf_parent_id']
         # need to set higher version number for pages we already updated with attachments
-        if child_conf_id in attachments_formatted:
-            vers_num = 3
-        else:
-            vers_num = 2
+        vers_num = 3 if child_conf_id in attachments_formatted else 2
         # requires id above 0 because 0 indicates the page was not created (usually due to duplicate name error)
         if parent_conf_id is not None and int(parent_conf_id) > 0:
-            data_to_update = {
-                'id': child_conf_id,
-                'type': 'page',
-                'ancestors': [{'type': 'page', 'id': str(parent_conf_id)}],
-                'title': page_title,
-                "version": {
-                    "number": vers_num
-                }
+            parent_updates.append((child_conf_id, parent_conf_id, page_meta['page_title'], vers_num))
+
+
+    def put_parent_update(parent_update):
+        child_conf_id, parent_conf_id, page_title, vers_num = parent_update
+        data_to_update = {
+            'id': child_conf_id,
+            'type': 'page',
+            'ancestors': [{'type': 'page', 'id': str(parent_conf_id)}],
+            'title': page_title,
+            "version": {
+                "number": vers_num
             }
-            url_string = "{}rest/api/content/{}".format(conf_endpoint, child_conf_id)
-            r = s.put(url_string
-                      , data=json.dumps(data_to_update)
-                      , headers=conf_headers
-                      , cookies=conf_cookies
-                      )
-
-            logger.debug("Update Parent Page for ::{}:: (id: {}) Status: {}"
-                         .format(page_title, child_conf_id, r.status_code))
-            if r.status_code != 200:
-                logger.debug(r.text)
-                alert_items.append(
-                    "Had issue updating the parent page for ::{}:: in Confluence, so navigation may be incorrect. See debug logs.".format(
-                        page_title))
+        }
+        url_string = "{}rest/api/content/{}".format(conf_endpoint, child_conf_id)
+        return s.put(url_string
+                     , data=json.dumps(data_to_update)
+                     , timeout=30
+                     )
+
+
+    # results come back in submission order, so the bookkeeping stays simple
+    for i, (parent_update, r) in enumerate(zip(parent_updates,
+                                               fetch_pool.map(put_parent_update, parent_updates))):
+        if i % 20 == 0 and i != 0:
+            logger.info("Updated {}/{} Confluence parent ids so far".format(i, number_of_pages_to_download))
+        child_conf_id, parent_conf_id, page_title, vers_num = parent_update
+        logger.debug("Update Parent Page for ::{}:: (id: {}) Status: {}"
+                     .format(page_title, child_conf_id, r.status_code))
+        if r.status_code != 200:
+            logger.debug(r.text)
+            alert_items.append(
+                "Had issue updating the parent page for ::{}:: in Confluence, so navigation may be incorrect. See debug logs.".format(
+                    page_title))
 
 endSyncTime = datetime.now()
 logger.info("Process done in %s seconds", round((endSyncTime - startSyncTime).total_seconds()))
@@ -1015,52 +1218,10 @@ if len(alert_items) > 0:
         logger.info("--> {}".format(alert))
 
 if len(pages_to_download) > 0:
-    os.chdir(local_wiki_directory)
-    with open("results.html", "w", encoding='utf-8') as file:
-        pages_rows = ""
-        for p in pages_to_download:
-            attachment_meta_data = ""
-            try:
-                for atta in attachments_to_download[p['page_id']]:
-                    attachment_meta_data = attachment_meta_data + "<strong>" + atta['title'] + "</strong>" + " || " + \
-                                           atta['size_human'] + "<br/>"
-            except:
-                pass
-
-            possible_link_problems = ""
-            try:
-                for li in possible_link_issues[p['page_id']]:
-                    possible_link_problems = possible_link_problems \
-                                             + "<strong><a href={} target='_blank'>{}</a></strong> || {}<br/>".format(li['url'], li['text'], li['url'])
-            except:
-                pass
-
-            conf_page_id_str = confluence_page_mapping[p['page_id']]['conf_page_id']
-            conf_page_link = ""
-            try:
-                conf_page_id_value = confluence_page_mapping[p['page_id']]['conf_page_id']
-                conf_page_link = "<a href='{}display/{}/{}' target='_blank'>{}</a>".format(conf_endpoint, conf_space_name, p['title'], conf_page_id_str)
-            except:
-                pass
-
-            pages_rows = pages_rows + """
-                    <tr>
-                        <td>{}</td>
-                        <td>{}</td>
-                        <td>{}</td>
-                        <td>{}</td>
-                        <td>{}</td>
-                        <td>{}</td>
-                        <td>{}</td>
-                        <td>{}</td>
-                        <td><a href="{}">Link</a></td>
-                        <td>{}</td>
-                        <td>{}</td>
-                    </tr>
-                    """.format(p['title'], p['page_id'], p['author'], p['created'], p['modifier'], p['modified'],
-                               p['parent_id'], conf_page_link, p['link'], attachment_meta_data, possible_link_problems)
-
-        html_to_write = """
+    with open(os.path.join(local_wiki_directory, "results.html"), "w", encoding='utf-8') as file:
+        # stream the report straight to the file - header, one row at a time,
+        # then footer - so the full table never has to sit in memory
+        file.write("""
 <!doctype html>
 <html lang="en">
   <head>
@@ -1073,7 +1234,7 @@ if len(pages_to_download) > 0:
 
     <title>Results from W3 to Confluence Sync</title>
   </head>
-  <body>        
+  <body>
     <div class="container-fluid">
     <h3>Downloaded Pages from W3</h3>
         <div class="table-responsive">
@@ -1093,15 +1254,50 @@ if len(pages_to_download) > 0:
               <th scope="col">Possible Link Issues</th>
             </tr>
           </thead>
-          <tbody>
-            {}
+          <tbody>""")
+        for p in pages_to_download:
+            # plain .get() lookups - pages without attachments/issues/conf ids
+            # are the common case and shouldn't pay for raising an exception
+            attachment_meta_parts = []
+            for atta in attachments_to_download.get(p['page_id']) or ():
+                attachment_meta_parts.append(
+                    f"<strong>{atta['title']}</strong> || {atta['size_human']}<br/>")
+            attachment_meta_data = "".join(attachment_meta_parts)
+
+            possible_link_parts = []
+            for li in possible_link_issues.get(p['page_id']) or ():
+                possible_link_parts.append(
+                    f"<strong><a href={li['url']} target='_blank'>{li['text']}</a></strong> || {li['url']}<br/>")
+            possible_link_problems = "".join(possible_link_parts)
+
+            conf_page_link = ""
+            page_mapping_entry = confluence_page_mapping.get(p['page_id'])
+            if page_mapping_entry is not None:
+                conf_page_id_str = page_mapping_entry['conf_page_id']
+                conf_page_link = f"<a href='{conf_endpoint}display/{conf_space_name}/{p['title']}' target='_blank'>{conf_page_id_str}</a>"
+
+            file.write(f"""
+                    <tr>
+                        <td>{p['title']}</td>
+                        <td>{p['page_id']}</td>
+                        <td>{p['author']}</td>
+                        <td>{p['created']}</td>
+                        <td>{p['modifier']}</td>
+                        <td>{p['modified']}</td>
+                        <td>{p['parent_id']}</td>
+                        <td>{conf_page_link}</td>
+                        <td><a href="{p['link']}">Link</a></td>
+                        <td>{attachment_meta_data}</td>
+                        <td>{possible_link_problems}</td>
+                    </tr>
+                    """)
+
+        file.write("""
           </tbody>
         </table>
         </div>
     </div>
   </body>
-</html>""".format(pages_rows)
-
-        file.write(html_to_write)
+</html>""")
 
         logger.info("See tabular output of the work done here: {}".format(os.path.join(local_wiki_directory, 'results.html')))